@@ -21,15 +21,24 @@ Anki are as follows:
        downloaded, and using the cookies.txt file you just exported. 
     4. In Anki, import the text file that the script created. 
 That's it! 
+
+The ETag and Last-Modified headers sent with each photo are saved in a file 
+named UCLA_Student_photos.json in the Anki directory. When the script is run 
+again, photos that my.ucla reports as unchanged are not downloaded again. 
 """
 
 import sys
 import os
 import argparse
-import subprocess
 import re
 import csv
-import filecmp
+import json
+import hashlib
+import itertools
+import collections
+from http.cookiejar import MozillaCookieJar
+from concurrent.futures import ThreadPoolExecutor
+import requests     # Requires requests: pip install requests
 
 parser = argparse.ArgumentParser(description=DESCRIPTION, epilog=EPILOG, 
         formatter_class=argparse.RawDescriptionHelpFormatter)
@@ -69,19 +78,34 @@ args = parser.parse_args()
 
 #NAMEFORMAT = re.compile(r'(?P<lastname>[^,]+)(,\s+(?P<firstname>\S+)(\s+(?P<middlename>[^,(]+))?(,\s+(?P<suffix>\S+))?)?(\s+[(](P<realname>.*)[)])?')
 PARENSFORMAT = re.compile(r'(.*)[(](.*)[)](.*)')
-def name_case(name):
-    "Take a single (possibly hyphenated) word from a name and change its case"
-
-    def name_case_hyphenated(name):
-        if name in ("de", "el", "la", "los", "las"):
-            return name
-        return "-".join([name_case_word(word) for word in name.split("-")])
-    def name_case_word(name):
-        name = name[:1].upper() + name[1:]    # No, I don't mean to use title()
-        if name[:2] in ("Mc", "O'", "D'"):
-            name = name[:2] + name[2:3].upper() + name[3:]
+# One regex scan does all of the work of name_case(): each match is a run of 
+# whitespace, a lowercase particle standing alone as a word, or one piece of a 
+# (possibly hyphenated) word. 
+NAME_PARTICLES = ("de", "el", "la", "los", "las")
+NAME_PREFIXES = ("mc", "o'", "d'")
+NAME_PREFIXES_CASED = {prefix: prefix.title() for prefix in NAME_PREFIXES}
+NAME_TOKEN = re.compile(r"(?P<space>\s+)|(?P<particle>(?<!\S)(?:{})(?!\S))|"
+        r"[^\s-]+".format("|".join(NAME_PARTICLES)))
+def name_case_token(match):
+    "Change the case of a single token of a name matched by NAME_TOKEN"
+
+    if match.lastgroup == "space":
+        return " "
+    name = match.group()
+    if match.lastgroup == "particle":
         return name
-    return " ".join([name_case_hyphenated(word) for word in name.split()])
+    # The name was lowercased by format_name, so the prefixes can be checked 
+    # first, and the first letter can be uppercased without calling upper()
+    if name.startswith(NAME_PREFIXES):
+        return NAME_PREFIXES_CASED[name[:2]] + name[2:3].upper() + name[3:]
+    if "a" <= name[:1] <= "z":    # No, I don't mean to use title()
+        return chr(ord(name[0]) - 32) + name[1:]
+    return name
+
+def name_case(name):
+    "Change the case (and possibly spacing) of a lowercased name"
+
+    return NAME_TOKEN.sub(name_case_token, name.strip())
 
 def format_name(name):
     name = name.lower()
@@ -123,6 +147,22 @@ def format_name(name):
         (realfirstname, middlename, lastname, suffix)))
     return preferredname, fullname
 
+def file_digest(path):
+    "Hash the contents of a file, reading it in large chunks"
+
+    digest = hashlib.blake2b()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.digest()
+
+def same_contents(path, data):
+    "Check whether a file's contents are identical to 'data'"
+
+    # Comparing sizes first settles most mismatches without reading anything
+    return (os.path.getsize(path) == len(data) and 
+            file_digest(path) == hashlib.blake2b(data).digest())
+
 # Generate the name of the Anki import file from the name of the CSV file
 if args.download_only:
     ankifilepath = os.devnull
@@ -140,27 +180,114 @@ if not args.textfile_only:
             print("ERROR: {} is not a directory.".format(downloaddir))
             sys.exit(1)
 
+# Set up for downloading the photos. The downloads are independent of each 
+# other, and almost all of the time is spent waiting on the network, so several 
+# of them are run at once, in the background while the roster is still being 
+# read. All of them share one HTTP session, so that connections to my.ucla are 
+# kept alive and reused, rather than doing a new TLS handshake for every photo. 
+# For photos we already have, the ETag/Last-Modified headers from when they 
+# were downloaded are sent back, so an unchanged photo isn't downloaded again. 
+DOWNLOAD_THREADS = 16
+VALIDATORS_FILE = "UCLA_Student_photos.json"
+def download_photo(studentid):
+    "Download the photo for one student. Returns False if an error occurred."
+
+    url = photo_url.format(studentid.replace("-", ""))
+    print("Downloading photo for student with ID {}".format(studentid))
+    filename = "UCLA_Student_{}.jpg".format(studentid)
+    pathname = downloaddir_prefix + filename
+    headers = {}
+    if filename in existing_photos:
+        etag, last_modified = photo_validators.get(filename, (None, None))
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+    try:
+        with session.get(url, headers=headers, timeout=30) as response:
+            response.raise_for_status()
+            if response.status_code == 304:
+                # Not modified, so the photo we already have is current
+                return True
+            validators = (response.headers.get("ETag"), 
+                    response.headers.get("Last-Modified"))
+            data = response.content
+    except:
+        print("    An error occurred downloading the photo for {}.".format(
+                studentid))
+        return False
+    # The photo is small, so it's kept in memory until we know whether it's 
+    # different from the one we already have, and only written out if it is. 
+    if filename not in existing_photos:
+        with open(pathname, "wb") as photofile:
+            photofile.write(data)
+    elif not same_contents(pathname, data):
+        # The new one is different! Use the new one, but keep the old. Write 
+        # it to a temporary file first, so the old one is only replaced once 
+        # the new one is complete. 
+        newpathname = pathname[:-4] + ".new.jpg"
+        with open(newpathname, "wb") as photofile:
+            photofile.write(data)
+        os.rename(pathname, pathname[:-4] + ".old.jpg")
+        os.replace(newpathname, pathname)
+    if any(validators):
+        photo_validators[filename] = validators
+    return True
+
+pool = ThreadPoolExecutor(max_workers=DOWNLOAD_THREADS)
+if not args.textfile_only:
+    downloaddir_prefix = os.path.join(downloaddir, "")
+    # One directory listing, instead of checking for each photo separately
+    existing_photos = {entry.name for entry in os.scandir(downloaddir) 
+            if entry.name.startswith("UCLA_Student_")}
+    validatorspath = os.path.join(args.ankipath, VALIDATORS_FILE)
+    try:
+        with open(validatorspath, encoding="ascii") as validatorsfile:
+            photo_validators = json.load(validatorsfile)
+    except (OSError, ValueError):
+        photo_validators = {}
+    session = requests.Session()
+    session.mount("https://", requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=DOWNLOAD_THREADS))
+    session.cookies = MozillaCookieJar(args.cookiespath)
+    try:
+        session.cookies.load(ignore_discard=True, ignore_expires=True)
+    except OSError as e:
+        print("ERROR: Could not load cookies from {}: {}".format(
+                args.cookiespath, e))
+        sys.exit(1)
+
 # Load the existing Anki data, if given
 existing_students = {}
 if args.existing and not args.download_only:
-    with open(args.existing, newline="", encoding="ascii") as existingfile:
-        csvreader = csv.reader(existingfile, delimiter="\t", quotechar="'")
-        for studentid, url, prefname, fullname, foo, bar, tags in csvreader:
+    with open(args.existing, newline="", encoding="ascii", 
+            buffering=1 << 20) as existingfile:
+        # Anki's plain text export is simple enough (one note per line, with 
+        # tab-separated fields) that it can just be split up, without csv
+        for line in existingfile:
+            studentid, url, prefname, fullname, foo, bar, tags = \
+                    line.rstrip("\r\n").split("\t")
             existing_students[studentid] = (prefname, fullname, tags)
 
 # Read the given .CSV file to find names and ID numbers of students. As we find 
-# them, create the text file that Anki will import. 
+# them, create the lines of the text file that Anki will import, and start 
+# downloading their photos. The lines are collected and written out all at 
+# once, which matters when the file lives on a slow network or removable drive. 
 TERMABBREVS = {"W": "Winter", "S": "Spring", "1": "Summer", "F": "Fall"}
+ANKIROW = '{0};<img src="UCLA_Student_{0}.jpg">;{1};{2};{3}\n'
 downloads = []
-with open(args.csvfilepath, newline="", encoding="ascii") as csvfile, open(
-        ankifilepath, "w", encoding="ascii") as ankifile:
+ankirows = []
+with open(args.csvfilepath, newline="", encoding="ascii", 
+        buffering=1 << 20) as csvfile, open(ankifilepath, "w", 
+        encoding="ascii", buffering=1 << 20) as ankifile:
     csvreader = csv.reader(csvfile, delimiter=",", quotechar='"')
     term = next(csvreader)[0][len("Term: "):]
     classid = next(csvreader)[0][len("Class: "):].split()
     classid = classid[0] + classid[1] + "-" + classid[3]
     classid += "-" + TERMABBREVS[term[2]] + "-20" + term[:2]
-    for i in range(7):
-        next(csvreader)
+    photo_url = ("https://be.my.ucla.edu/fileRelay.aspx?"
+        "type=R&uid={{}}&term={}&ci={}").format(term, args.classindex)
+    collections.deque(itertools.islice(csvreader, 7), maxlen=0)
     for line in csvreader:
         if len(line) < 2:
             continue
@@ -182,54 +309,26 @@ with open(args.csvfilepath, newline="", encoding="ascii") as csvfile, open(
             tags += " " + classid
         else:
             tags = classid
-        ankifile.write(";".join((
-            studentid, 
-            '<img src="UCLA_Student_{}.jpg">'.format(studentid), 
-            preferredname, 
-            fullname, 
-            tags)) + "\n")
+        ankirows.append(ANKIROW.format(studentid, preferredname, fullname, tags))
         if not args.textfile_only:
-            downloads.append(studentid)
-
-# Now download all the photos for the students specified in list "downloads". 
-while downloads:
-    errors = []
-    for studentid in downloads:
-        url = ("https://be.my.ucla.edu/fileRelay.aspx?"
-            "type=R&uid={}&term={}&ci={}").format(studentid.replace("-", ""), 
-            term, args.classindex)
-        print("Downloading photo for student with ID {}".format(studentid))
-        filename = "UCLA_Student_{}.jpg".format(studentid)
-        pathname = os.path.join(ankimediadir, filename)
-        if os.path.exists(pathname):
-            newpathname = pathname[:-4] + ".new.jpg"
-        else:
-            newpathname = pathname
-        try:
-            subprocess.check_call(["wget", 
-                "--load-cookies={}".format(args.cookiespath), 
-                "-O", newpathname, url], stdout=subprocess.DEVNULL, 
-                stderr=subprocess.DEVNULL)
-        except:
-            print("    An error occurred with the previous download.")
-            errors.append(studentid)
-            continue
-        if newpathname != pathname:
-            if filecmp.cmp(newpathname, pathname):
-                # The new one is the same as the old one. 
-                os.remove(newpathname)
-            else:
-                # The new one is different! Use the new one, but keep the old. 
-                oldpathname = pathname[:-4] + ".old.jpg"
-                os.rename(pathname, oldpathname)
-                os.rename(newpathname, pathname)
+            downloads.append(
+                    (studentid, pool.submit(download_photo, studentid)))
+    ankifile.writelines(ankirows)
+
+# Now wait for all the photo downloads to finish, and retry any that failed
+results = [(studentid, future.result()) for studentid, future in downloads]
+while results:
+    errors = [studentid for studentid, success in results if not success]
     print("{} photos downloaded successfully, {} errors.".format(
-        len(downloads) - len(errors), len(errors)))
-    downloads = errors
+        len(results) - len(errors), len(errors)))
+    results = []
     if errors:
         print("Shall we retry the errors? [y/n] ")
         answer = sys.stdin.readline()
-        if answer.lower()[0] != "y":
-            break
-
+        if answer.lower()[0] == "y":
+            results = list(zip(errors, pool.map(download_photo, errors)))
+pool.shutdown()
+if not args.textfile_only:
+    with open(validatorspath, "w", encoding="ascii") as validatorsfile:
+        json.dump(photo_validators, validatorsfile, indent=4, sort_keys=True)
 
@@ -10,6 +10,7 @@ output to stdout.
 """
 
 import sys
+import itertools
 try:
     existingfilepath = sys.argv[1]
 except:
@@ -18,27 +19,25 @@ except:
 
 # Read the "existing" file to find all tags already associated to each known 
 # student ID number. 
-import csv
+# (The file has one note per line, with tab-separated fields, so it's simply 
+# split up, as bytes like the rest of the data below.) 
 students = {}
-with open(existingfilepath, newline="", encoding="ascii") as existingfile:
-    csvreader = csv.reader(existingfile, delimiter="\t", quotechar="'")
-    for studentid, url, name, foo, bar, bat, tags in csvreader:
+with open(existingfilepath, "rb", buffering=1 << 20) as existingfile:
+    for line in existingfile:
+        studentid, url, name, foo, bar, bat, tags = \
+                line.rstrip(b"\r\n").split(b"\t")
         students[studentid] = tags
 
 # Now read all the import data from stdin and create the output to write out. 
-# (For efficiency, we assume the input data has already been sorted.) 
-lastline = None
-for line in sys.stdin:
-    line = line.rstrip()
-    if lastline and lastline[:11] == line[:11]:
-        lastline += " " + line.split(";")[3]
-    else:
-        if lastline:
-            print(lastline)
-        lastline = line
-        try:
-            lastline += " " + students[lastline[:11]]
-        except KeyError:
-            pass
-print(lastline)
-
+# (For efficiency, we assume the input data has already been sorted, so that 
+# all the lines for each student ID number are next to each other.) The data 
+# is all ASCII, so it's handled as bytes, without decoding and encoding it. 
+output = []
+for studentid, lines in itertools.groupby(map(bytes.rstrip, sys.stdin.buffer), 
+        key=lambda line: line[:11]):
+    merged = [next(lines)]
+    if studentid in students:
+        merged.append(students[studentid])
+    merged.extend(line.split(b";")[3] for line in lines)
+    output.append(b" ".join(merged) + b"\n")
+sys.stdout.buffer.writelines(output)
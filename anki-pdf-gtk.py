@@ -4,22 +4,31 @@
 import sys
 import os
 import json
+import collections
+import contextlib
+import threading
 import appdirs  # Requires appdirs: pip install appdirs
 import gi       # Requires PyGObj/GTK: apt-get install python3-gi gir1.2-gtk-3.0
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk, GLib
 
-from photoroster import load_existing_students, PhotoRoster
+from photoroster import (load_existing_students, collection_signature, 
+        index_by_tag, PhotoRoster)
 
 APPNAME = "Anki-PhotoRoster"
 AUTHOR = "Will Conley"
 CONFIGFILE = "Anki-PhotoRoster.conf"
+ROSTER_CACHE_SIZE = 4
 
 class AutoBuilder(object):
+    WIDGETS = () # Widgets to look up right away, instead of on first use
+
     def __init__(self, ui_file):
         ui_path = os.path.join(sys.path[0], ui_file)
         self._builder = Gtk.Builder.new_from_file(ui_path)
         self._builder.connect_signals(self)
+        for name in self.WIDGETS:
+            setattr(self, name, self._builder.get_object(name))
 
     def __getattr__(self, attr):
         value = self._builder.get_object(attr)
@@ -28,6 +37,11 @@ class AutoBuilder(object):
 
 
 class MainWindow(AutoBuilder):
+    WIDGETS = ("window", "progressbar", "anki_folder_label", 
+            "anki_folder_image", "anki_folder_button", "anki_collection_label", 
+            "photo_roster_entry", "photo_roster_image", "photo_roster_button", 
+            "photo_roster_label", "tag_entry", "tag_label", "start_button")
+
     def __init__(self):
         "Initialize the main window of our application."
 
@@ -36,8 +50,11 @@ class MainWindow(AutoBuilder):
         self.progressbar.hide()
         self.anki_folder = preferences.get("anki_folder", None)
         self.roster = None
+        self._roster_cache = collections.OrderedDict()
+        self._existing_cache = {}
         self.tag = None
         self.this_course = None
+        self.import_thread = None
         self.check_anki_collection()
 
     def enable_all(self, enabled):
@@ -47,8 +64,24 @@ class MainWindow(AutoBuilder):
         self.start_button.set_sensitive(enabled)
 
     def check_anki_folder(self, path):
-        return (os.path.isdir(os.path.join(path, "collection.media")) and 
-                os.path.isfile(os.path.join(path, "collection.anki2")))
+        # One pass over the directory, which also tells us the type of each 
+        # entry, is cheaper than two separate stat() calls on a slow network 
+        # filesystem. This gets called each time the file chooser moves. 
+        found_media = found_collection = False
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.name == "collection.media":
+                        found_media = entry.is_dir()
+                    elif entry.name == "collection.anki2":
+                        found_collection = entry.is_file()
+                    else:
+                        continue
+                    if found_media and found_collection:
+                        return True
+        except OSError:
+            pass
+        return False
 
     def check_anki_collection(self):
         if not self.anki_folder:
@@ -64,9 +97,27 @@ class MainWindow(AutoBuilder):
         try:
             if not self.check_anki_folder(self.anki_folder):
                 raise ValueError()
-            self.existing_students = load_existing_students(self.anki_folder)
+            # If the collection hasn't changed since we last loaded it, reuse 
+            # what we loaded (and indexed) then, so check_tag can skip its 
+            # recomputation as well
+            key = collection_signature(self.anki_folder)
+            if key in self._existing_cache:
+                self.existing_students, self.tag_index = \
+                        self._existing_cache[key]
+            else:
+                self.existing_students = load_existing_students(
+                        self.anki_folder, 
+                        appdirs.user_cache_dir(APPNAME, AUTHOR))
+                # Index the students by tag, so check_tag doesn't need to 
+                # search through all of them every time the tag is changed
+                self.tag_index = index_by_tag(self.existing_students)
+                self._existing_cache.clear()
+                self._existing_cache[key] = (self.existing_students, 
+                        self.tag_index)
+                self.tag = None
         except:
             self.existing_students = None
+            self.tag_index = None
             self.anki_folder_image.set_from_icon_name("dialog-warning", 
                     Gtk.IconSize.LARGE_TOOLBAR)
             self.anki_collection_label.set_text("This folder does not appear " + 
@@ -81,17 +132,28 @@ class MainWindow(AutoBuilder):
             self.photo_roster_entry.set_sensitive(True)
             self.photo_roster_button.set_sensitive(True)
             self.check_photo_roster()
+            if self.tag is None and self.roster:
+                # check_photo_roster returns early if the roster is unchanged, 
+                # so recount the tag against the reloaded collection here
+                self.check_tag()
 
     def check_photo_roster(self):
         path = self.photo_roster_entry.get_text()
-        if self.roster and self.roster.path == path:
+        if self.roster and self.roster.path == os.path.abspath(path):
             return
         if not path:
             self.photo_roster_label.hide()
             return
         try:
-            self.roster = PhotoRoster(path)
-            tag = self.roster.course_tag
+            # Reuse the roster if we've already opened this same file (and it 
+            # hasn't changed since), rather than parsing it all over again
+            key = (path, os.path.getmtime(path))
+            roster = self._roster_cache.pop(key, None) or PhotoRoster(path)
+            tag = roster.course_tag
+            self._roster_cache[key] = roster
+            if len(self._roster_cache) > ROSTER_CACHE_SIZE:
+                self._roster_cache.popitem(last=False)
+            self.roster = roster
         except:
             self.photo_roster_image.set_from_icon_name("dialog-warning", 
                     Gtk.IconSize.LARGE_TOOLBAR)
@@ -118,17 +180,17 @@ class MainWindow(AutoBuilder):
         if self.tag == tag:
             return
         self.tag = tag
+        tag_label = self.tag_label
         if tag:
-            tag = " {} ".format(tag)
-            self.this_course = {idnumber for idnumber, (pn, fn, tags) in 
-                    self.existing_students.items() if tag in tags}
-            self.tag_label.show()
-            self.tag_label.set_text(("There are {} students with this tag " + 
+            self.this_course = this_course = self.tag_index.get(tag, 
+                    frozenset())
+            tag_label.show()
+            tag_label.set_text(("There are {} students with this tag " + 
                     "in your current Anki collection.").format(
-                    len(self.this_course)))
+                    len(this_course)))
         else:
-            self.this_course = set()
-            self.tag_label.hide()
+            self.this_course = frozenset()
+            tag_label.hide()
 
     def anki_folder_button_clicked(self, button):
         dialog = Gtk.FileChooserDialog(title="Choose your Anki data folder", 
@@ -188,8 +250,12 @@ class MainWindow(AutoBuilder):
         return False
 
     def photo_roster_entry_focus_out_event(self, entry, event):
-        path = os.path.expanduser(entry.get_text())
-        entry.set_text(path)
+        # Only rewrite the text if it actually changes, since every set_text 
+        # emits more signals
+        path = entry.get_text()
+        expanded = os.path.expanduser(path)
+        if expanded != path:
+            entry.set_text(expanded)
         self.check_photo_roster()
         return False
 
@@ -198,38 +264,96 @@ class MainWindow(AutoBuilder):
         return False
 
     def quit_button_clicked(self, button, event=None):
+        if self.import_thread is not None:
+            # Let the import finish the student it's working on, so we don't 
+            # quit in the middle of saving a photo. Waiting for it here would 
+            # freeze the window, so hide it, and quit from import_finished. 
+            self.cancel_import.set()
+            self.window.hide()
+            return True # Don't destroy the window until then
         Gtk.main_quit()
         return False
 
     def start_button_clicked(self, button):
-        iterator = self.main_iterator()
-        GLib.idle_add(lambda: next(iterator, False), priority=GLib.PRIORITY_LOW)
-
-    def main_iterator(self):
-        photodir = os.path.join(self.anki_folder, "collection.media")
-        outfilepath = os.path.splitext(self.roster.path)[0] + ".Anki_Import.txt"
-        num_students = self.roster.num_students
+        # The import itself runs in a separate thread, so that reading the PDF 
+        # and saving the photos doesn't hold up the GUI
+        self.enable_all(False)
+        self.anki_folder_button.set_sensitive(False)
         self.progressbar.show()
         self.progressbar.set_fraction(0)
         #self.progressbar.set_text(None) # Is this needed? Not sure yet...
         conflict_dialog = ConflictDialog(self.window, self.existing_students)
-        with open(outfilepath, "w") as outfile:
-            for n, student in enumerate(self.roster):
-                self.this_course.discard(student.idnumber)
-                photo_backup = student.save_photo(photodir)
-                conflict_dialog.check_existing(student, photo_backup)
-                print(student, file=outfile)
-                self.progressbar.set_fraction(n / num_students)
-                yield True
-        if self.this_course:
+        self.cancel_import = threading.Event()
+        self.import_thread = threading.Thread(target=self.run_import, 
+                args=(conflict_dialog, self.cancel_import), daemon=True)
+        self.import_thread.start()
+
+    def run_import(self, conflict_dialog, cancel_import):
+        "Import the roster. This runs in its own thread: no direct GUI calls!"
+
+        photodir = os.path.join(self.anki_folder, "collection.media")
+        outfilepath = os.path.splitext(self.roster.path)[0] + ".Anki_Import.txt"
+        num_students = self.roster.num_students
+        seen = set()
+        last_percent = 0
+        dropped = frozenset()
+        error = None
+        try:
+            existing_photos = set(os.listdir(photodir))
+            with open(outfilepath, "w", buffering=1 << 20) as outfile, \
+                    contextlib.closing(iter(self.roster)) as students:
+                for n, student in enumerate(students):
+                    if cancel_import.is_set():
+                        break
+                    seen.add(student.idnumber)
+                    photo_backup = student.save_photo(photodir, 
+                            existing_photos)
+                    conflict_dialog.check_existing(student, photo_backup)
+                    outfile.write(str(student) + "\n")
+                    # Only bother the main loop when the progress bar would 
+                    # visibly change, rather than after every single student
+                    percent = n * 100 // num_students
+                    if percent != last_percent:
+                        last_percent = percent
+                        GLib.idle_add(self.progressbar.set_fraction, 
+                                percent / 100)
+            dropped = self.this_course - seen
+        except Exception as e:
+            error = e
+        GLib.idle_add(self.import_finished, conflict_dialog, dropped, error)
+
+    def import_finished(self, conflict_dialog, dropped, error):
+        "Called back in the main thread once run_import is done"
+
+        self.import_thread = None
+        if self.cancel_import.is_set(): # The user quit during the import
+            Gtk.main_quit()
+            return False
+        self.enable_all(True)
+        self.anki_folder_button.set_sensitive(True)
+        if error is not None:
+            self.progressbar.hide()
+            dialog = Gtk.MessageDialog(transient_for=self.window, modal=True, 
+                    message_type=Gtk.MessageType.ERROR, 
+                    buttons=Gtk.ButtonsType.CLOSE, 
+                    text="The import did not finish.")
+            dialog.format_secondary_text(str(error))
+            dialog.connect("response", lambda dialog, response_id: 
+                    dialog.destroy())
+            dialog.show()
+            return False
+        self.progressbar.set_fraction(1)
+        conflict_dialog.show_conflicts()
+        if dropped:
             # Need to open a dialog for this instead... Offer to save somewhere?
             print("The following students were already tagged as being in this ")
             print("course in your Anki database, but they're not on this roster. ")
             print("This probably means you've previously imported a roster for ")
             print("this class, and these students have since dropped the class: ")
-        for idnumber in self.this_course:
-            preferredname, fullname, tags = self.existing_students[idnumber]
-            print("    {} ({})".format(preferredname, fullname))
+        sys.stdout.write("".join("    {} ({})\n".format(
+                *conflict_dialog.existing_students[idnumber][:2])
+                for idnumber in dropped))
+        return False
 
 
 class ConflictDialog(AutoBuilder):
@@ -239,6 +363,7 @@ class ConflictDialog(AutoBuilder):
         super().__init__("conflict-dialog.ui")
         self.dialog.set_transient_for(parent)
         self.existing_students = existing_students
+        self.conflicts = []
         self.dialog.hide()
 
     def check_existing(self, student, existing_photo):
@@ -246,11 +371,12 @@ class ConflictDialog(AutoBuilder):
         if not existing:
             return
         preferredname, fullname, tags = existing
-        student.merge_tags(tags.split())
+        student.merge_tags(sorted(tags))
         if (preferredname == student.preferredname and 
                 fullname == student.fullname and not existing_photo):
             return
-        message = "Found some changes:\n"
+        message = "Found some changes for {} ({}):\n".format(
+                student.preferredname, student.idnumber)
         if existing_photo:
             photodir = os.path.dirname(existing_photo)
             new_photo = os.path.join(photodir, student.photo_filename())
@@ -259,10 +385,31 @@ class ConflictDialog(AutoBuilder):
             message += "    Pref. name: {} ---> {}\n".format(preferredname, student.preferredname)
         if fullname != student.fullname:
             message += "    Full name: {} ---> {}\n".format(fullname, student.fullname)
+        # Don't stop to show each one; they're all shown by show_conflicts()
+        self.conflicts.append((student, existing_photo, message))
+
+    def show_conflicts(self):
+        "Show all the conflicts found by check_existing in a single dialog."
+
+        if not self.conflicts:
+            return
         parent = self.dialog.get_transient_for()
-        dialog = Gtk.MessageDialog(parent, Gtk.DialogFlags.MODAL | Gtk.DialogFlags.DESTROY_WITH_PARENT, Gtk.MessageType.INFO, Gtk.ButtonsType.OK, message)
+        dialog = Gtk.Dialog(title="Changes found", transient_for=parent, 
+                modal=True, destroy_with_parent=True)
+        dialog.add_button("_OK", Gtk.ResponseType.OK)
+        dialog.set_default_size(600, 400)
+        label = Gtk.Label(label="\n".join(
+                [message for student, photo, message in self.conflicts]))
+        label.set_selectable(True)
+        label.set_xalign(0)
+        label.set_yalign(0)
+        scrolled = Gtk.ScrolledWindow()
+        scrolled.add(label)
+        dialog.get_content_area().pack_start(scrolled, True, True, 0)
+        dialog.show_all()
         dialog.run()
         dialog.destroy()
+        self.conflicts = []
 
     def check_existing2(self, student, existing_photo):
         existing = self.existing_students.get(student.idnumber)
@@ -274,7 +421,7 @@ class ConflictDialog(AutoBuilder):
                         student.preferredname, existing_photo))
             return
         preferredname, fullname, tags = existing
-        student.merge_tags(tags.split())
+        student.merge_tags(sorted(tags))
         if (preferredname == student.preferredname and 
                 fullname == student.fullname and not existing_photo):
             return
@@ -332,8 +479,9 @@ class ConflictDialog(AutoBuilder):
 if __name__ == "__main__":
     # First, load preferences from config file, if present
     configdir = appdirs.user_config_dir(APPNAME, AUTHOR)
+    configpath = os.path.join(configdir, CONFIGFILE)
     try:
-        with open(os.path.join(configdir, CONFIGFILE)) as configfile:
+        with open(configpath) as configfile:
             preferences = json.load(configfile)
     except:
         preferences = {}
@@ -345,7 +493,7 @@ if __name__ == "__main__":
     # Save preferences to config file
     os.makedirs(configdir, mode=0o700, exist_ok=True)
     try:
-        with open(os.path.join(configdir, CONFIGFILE), "w") as configfile:
+        with open(configpath, "w") as configfile:
             json.dump(preferences, configfile, indent=4)
     except Exception as e:
         print("Error when trying to save config file:", e)
@@ -28,10 +28,11 @@ these duplicate photos. (All of this functionality should be improved in a
 later version.) 
 """
 
+import sys
 import os
 import argparse
 
-from photoroster import load_existing_students, PhotoRoster
+from photoroster import load_existing_students, index_by_tag, PhotoRoster
 
 
 def parse_args():
@@ -47,6 +48,12 @@ def parse_args():
     parser.add_argument("ankidir", 
         help="""The directory where your personal Anki files are stored. On a 
             Mac or Linux system, this will usually be ~/Anki/[YOUR NAME]/""")
+    parser.add_argument("--reencode", action="store_true", 
+        help="""Re-encode the photos taken from the roster, rather than 
+            extracting the original JPEG photos with the pdfimages program. 
+            (Photos are always re-encoded if pdfimages isn't installed.) Note 
+            that re-encoded photos won't match photos previously extracted 
+            with pdfimages, so they will all be reported as changed.""")
     return parser.parse_args()
 
 
@@ -67,7 +74,7 @@ def check_existing(student, existing_students):
         print("    Keeping the names in Anki. You may want to change this.")
         student.preferredname = preferredname
         student.fullname = fullname
-    student.merge_tags(tags.split())
+    student.merge_tags(sorted(tags))
 
 
 if __name__ == "__main__":
@@ -81,15 +88,16 @@ if __name__ == "__main__":
         raise FileNotFoundError("Directory {} does not exist".format(photodir))
     existing_students = load_existing_students(args.ankidir)
     print("Read {} existing people from Anki.".format(len(existing_students)))
-    roster = PhotoRoster(args.photoroster)
-    course_tag = " {} ".format(roster.course_tag)
-    this_course = {idnumber for idnumber, (pn, fn, tags) in 
-            existing_students.items() if course_tag in tags}
+    roster = PhotoRoster(args.photoroster, not args.reencode)
+    this_course = index_by_tag(existing_students).get(
+            roster.course_tag, frozenset())
     print("    {} of them in this class.".format(len(this_course)))
-    with open(ankifilepath, "w") as ankifile:
+    existing_photos = set(os.listdir(photodir))
+    seen = set()
+    with open(ankifilepath, "w", buffering=1 << 20) as ankifile:
         for student in roster:
-            this_course.discard(student.idnumber)
-            photo_backup = student.save_photo(photodir)
+            seen.add(student.idnumber)
+            photo_backup = student.save_photo(photodir, existing_photos)
             if photo_backup:
                 print("WARNING: A different photo already exists for " + 
                         "{}.".format(student.preferredname))
@@ -98,14 +106,14 @@ if __name__ == "__main__":
                 print("    The new one is {}.".format(
                         os.path.join(photodir, student.photo_filename())))
             check_existing(student, existing_students)
-            print(student, file=ankifile)
-    if this_course:
+            ankifile.write(str(student) + "\n")
+    dropped = this_course - seen
+    if dropped:
         print("The following students were already tagged as being in this ")
         print("course in your Anki database, but they're not on this roster. ")
         print("This probably means you've previously imported a roster for ")
         print("this class, and these students have since dropped the class: ")
-    for idnumber in this_course:
-        preferredname, fullname, tags = existing_students[idnumber]
-        print("    {} ({})".format(preferredname, fullname))
+    sys.stdout.write("".join("    {} ({})\n".format(
+            *existing_students[idnumber][:2]) for idnumber in dropped))
 
 
@@ -6,11 +6,18 @@ import subprocess
 import re
 import sqlite3
 import json
+import pickle
 import shutil
-import filecmp
+import functools
+import hashlib
+import itertools
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from contextlib import ExitStack
 from tempfile import TemporaryDirectory
 
+import numpy as np  # Requires numpy: pip install numpy
 import gi
 gi.require_version("Poppler", "0.18")
 gi.require_version("Gdk", "3.0")
@@ -18,57 +25,191 @@ from gi.repository import Poppler
 from gi.repository import Gdk
 
 pdfimages_path = shutil.which("pdfimages")
+EXISTING_CACHE_FILE = "existing.pkl"
+EXISTING_CACHE_VERSION = 2
 
 
-def load_existing_students(ankidir):
-    "Load the existing Anki data. This has nothing to do with PDFs."
+def collection_signature(ankidir):
+    """Identify the current state of the Anki collection in 'ankidir'
+
+    Returns a tuple of (path, modification time, size) for each of the 
+    collection's database files, so it changes whenever the collection does. 
+    """
+
+    collection = os.path.join(os.path.abspath(os.path.expanduser(ankidir)), 
+            "collection.anki2")
+    signature = []
+    for path in (collection, collection + "-wal"):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        signature.append((path, stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+def load_existing_students(ankidir, cachedir=None):
+    """Load the existing Anki data. This has nothing to do with PDFs.
+
+    Returns a dict mapping each student ID number to a tuple of the form 
+    (preferred_name, full_name, tags), where tags is a frozenset of strings. 
+
+    If cachedir is given, the data is also cached in a file in that directory, 
+    and the cached copy is used for as long as the Anki collection is unchanged 
+    (judging by the modification time and size of its database files). 
+    """
 
-    existing_students = {}
     ankidir = os.path.abspath(os.path.expanduser(ankidir))
-    uri = "file://{}?mode=ro".format(os.path.join(ankidir, "collection.anki2"))
+    collection = os.path.join(ankidir, "collection.anki2")
+    if not cachedir:
+        return _read_existing_students(collection)
+    cachepath = os.path.join(cachedir, EXISTING_CACHE_FILE)
+    signature = [EXISTING_CACHE_VERSION, collection]
+    signature.extend(collection_signature(ankidir))
+    try:
+        with open(cachepath, "rb") as cachefile:
+            cached_signature, existing_students = pickle.load(cachefile)
+        if cached_signature == signature:
+            return existing_students
+    except Exception:
+        pass # No usable cache, so just read the collection itself
+    existing_students = _read_existing_students(collection)
+    try:
+        os.makedirs(cachedir, exist_ok=True)
+        with open(cachepath + ".tmp", "wb") as cachefile:
+            pickle.dump((signature, existing_students), cachefile, 
+                    pickle.HIGHEST_PROTOCOL)
+        os.replace(cachepath + ".tmp", cachepath)
+    except OSError:
+        pass # Failing to cache is no reason to fail to load
+    return existing_students
+
+SQLITE_MMAP_SIZE = 1 << 28 # 256 MiB, more than enough for most collections
+
+MODEL_ID_QUERY = """
+    SELECT key FROM col, json_each(col.models) 
+    WHERE json_extract(value, '$.name') = ?;
+"""
+
+# Pick out the ID number, preferred name and full name (the first, third and 
+# fourth fields) of each note inside SQLite, rather than fetching all the 
+# fields and splitting them up in Python. a, b, c and d are the positions of 
+# the first four field separators (d = c if the full name is the last field). 
+EXISTING_STUDENTS_QUERY = """
+    WITH n1 AS (SELECT flds, tags, instr(flds, char(31)) AS a 
+                FROM notes WHERE mid = ?), 
+         n2 AS (SELECT *, a + instr(substr(flds, a + 1), char(31)) AS b 
+                FROM n1), 
+         n3 AS (SELECT *, b + instr(substr(flds, b + 1), char(31)) AS c 
+                FROM n2), 
+         n4 AS (SELECT *, c + instr(substr(flds, c + 1), char(31)) AS d 
+                FROM n3) 
+    SELECT substr(flds, 1, a - 1), substr(flds, b + 1, c - b - 1), 
+           CASE WHEN d > c THEN substr(flds, c + 1, d - c - 1) 
+                ELSE substr(flds, c + 1) END, 
+           tags 
+    FROM n4 WHERE c > b AND b > a AND a > 0;
+"""
+
+def _read_existing_students(collection):
+    "Read the students from the Anki collection database at 'collection'"
+
+    uri = "file://{}?mode=ro".format(collection)
     with sqlite3.connect(uri, uri=True) as db:
-        models = json.loads(db.execute("SELECT models FROM col;").fetchone()[0])
-        for modelID, model in models.items():
-            if model["name"] == "Names and faces":
-                break
-        else:
+        # Let SQLite map the database into memory, rather than read() it 
+        db.execute("PRAGMA mmap_size = {};".format(SQLITE_MMAP_SIZE))
+        try:
+            # Let SQLite find the note type, without decoding all of the models 
+            row = db.execute(MODEL_ID_QUERY, ("Names and faces", )).fetchone()
+            modelID = row[0] if row else None
+        except sqlite3.OperationalError: # SQLite without the JSON functions
+            models = json.loads(
+                    db.execute("SELECT models FROM col;").fetchone()[0])
+            for modelID, model in models.items():
+                if model["name"] == "Names and faces":
+                    break
+            else:
+                modelID = None
+        if modelID is None:
             raise ValueError("Did not find note type called 'Names and faces'.")
-        cursor = db.execute("SELECT flds, tags FROM notes WHERE mid = ? ;", 
-                (modelID, ))
-        for (fields, tags) in cursor:
-            idnumber, url, prefname, fullname, *junk = fields.split("\x1f")
-            existing_students[idnumber] = (prefname, fullname, tags)
-    return existing_students
+        cursor = db.execute(EXISTING_STUDENTS_QUERY, (modelID, ))
+        return {idnumber: (prefname, fullname, frozenset(tags.split())) 
+                for (idnumber, prefname, fullname, tags) in cursor}
+
+def index_by_tag(existing_students):
+    "Index the existing students by tag, as a dict of tag -> set of ID numbers"
+
+    index = {}
+    for idnumber, (prefname, fullname, tags) in existing_students.items():
+        for tag in tags:
+            index.setdefault(tag, []).append(idnumber)
+    return {tag: frozenset(idnumbers) for tag, idnumbers in index.items()}
+
+
+@functools.lru_cache(maxsize=16)
+def open_document(path, mtime):
+    """Open the PDF file at 'path' with Poppler
+
+    Documents are cached, so that opening the same file again doesn't parse it 
+    all over again. The modification time of the file is only there so that 
+    a cached document isn't reused after the file changes. 
+    """
+
+    return Poppler.Document.new_from_file("file://" + path)
 
 
 TERM_ABBREVS = {"W": "Winter", "S": "Spring", "1": "Summer", "F": "Fall"}
-COURSEDESC_FORMAT = re.compile(r'\s*(\S+)\s+(\S+)\s+\S+\s+(\S+)\s+-\s+(\S+)\s*')
+COURSEDESC_FORMAT = re.compile(
+        r'Photo Roster for \s*(\S+)\s+(\S+)\s+\S+\s+(\S+)\s+-\s+(\S+)\s*')
+PAGES_PER_WORKER = 4 # Pages of a roster handled by each worker process
+POOL_MIN_PAGES = 50  # Smaller rosters are quicker to read without workers
+ENCODE_THREADS = 4   # Threads encoding photos as JPEGs, when not pdfimages
 class PhotoRoster(object):
-    def __init__(self, path):
-        "Create a PhotoRoster object from the photo roster PDF file at 'path'"
+    def __init__(self, path, use_pdfimages=True):
+        """Create a PhotoRoster object from the photo roster PDF file at 'path'
+
+        By default, if the pdfimages program is installed, the original JPEG 
+        photos are extracted from the roster with it, unchanged. If 
+        use_pdfimages is false (or pdfimages isn't installed), the photos are 
+        taken from Poppler instead, and re-encoded as JPEGs when they're saved. 
+        Note that a re-encoded photo won't be byte-for-byte identical to one 
+        that was extracted with pdfimages. 
+        """
 
         self.path = os.path.abspath(os.path.expanduser(path))
+        self.use_pdfimages = use_pdfimages and bool(pdfimages_path)
         if not os.path.isfile(self.path):
             raise FileNotFoundError("File not found: {}".format(self.path))
-        uri = "file://" + self.path
-        self.roster = Poppler.Document.new_from_file(uri)
+        self._roster = None
         self._course_tag = None
+        self._num_students = None
+
+    @property
+    def roster(self):
+        "The Poppler document for this roster, opened the first time it's used"
+
+        if self._roster is None:
+            self._roster = open_document(self.path, 
+                    os.path.getmtime(self.path))
+        return self._roster
 
     @property
     def num_students(self):
         "Quickly calculate the number of students in this photo roster"
 
-        n = self.roster.get_n_pages() - 1
-        return n * 6 + len(self.roster.get_page(n).get_image_mapping())
+        if self._num_students is None:
+            n = self.roster.get_n_pages() - 1
+            self._num_students = n * 6 + len(
+                    self.roster.get_page(n).get_image_mapping())
+        return self._num_students
 
     @property
     def course_tag(self):
         "Get the course tag (e.g. 'MATH115A-7-Fall-2013') from top of roster"
 
         if self._course_tag is None:
-            header_text = self.roster.get_page(0).get_text().splitlines()[0]
-            match = COURSEDESC_FORMAT.fullmatch(
-                    header_text[len("Photo Roster for "):])
+            header_text = self.roster.get_page(0).get_text().partition("\n")[0]
+            match = COURSEDESC_FORMAT.fullmatch(header_text)
             if not match:
                 raise ValueError("Could not parse course description {}".format(
                         header_text))
@@ -82,62 +223,228 @@ class PhotoRoster(object):
     def __iter__(self):
         "Iterate over this roster, yielding a Student object for each student"
 
-        with ExitStack() as context_mgr_stack: # Does nothing, for now
-            if pdfimages_path:
-                # Create a temp directory, and dump all the photos in it
+        with ExitStack() as context_mgr_stack:
+            if self.use_pdfimages:
+                # Create a temp directory, for pdfimages to dump the photos in
                 # Thanks to the context manager, it's automagically cleaned up
                 tempdir = context_mgr_stack.enter_context(TemporaryDirectory())
                 image_prefix = os.path.join(tempdir, "photo")
-                subprocess.check_call(
-                        [pdfimages_path, "-j", self.path, image_prefix], 
-                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                encoder = None
+            else:
+                image_prefix = None
+                # Encode the photos as JPEGs in a few threads, a little ahead 
+                # of the student who's being yielded
+                encoder = context_mgr_stack.enter_context(
+                        ThreadPoolExecutor(max_workers=ENCODE_THREADS))
+                encoding = collections.deque()
+            # Find the students' ID numbers and names (and extract their 
+            # photos, if we're using pdfimages), a block of pages at a time. 
+            # Poppler documents can't be shared between processes, so each 
+            # worker process opens the roster for itself. 
+            n_pages = self.roster.get_n_pages()
+            blocks = [range(first, min(first + PAGES_PER_WORKER, n_pages)) 
+                    for first in range(0, n_pages, PAGES_PER_WORKER)]
+            if n_pages >= POOL_MIN_PAGES:
+                pool = ProcessPoolExecutor(
+                        max_workers=min(os.cpu_count() or 1, len(blocks)), 
+                        mp_context=multiprocessing.get_context("spawn"))
+                # If we're closed early, only wait for the blocks that are 
+                # already being read, not for the rest of the roster
+                context_mgr_stack.callback(pool.shutdown, cancel_futures=True)
+                results = pool.map(_extract_pages, itertools.repeat(self.path), 
+                        blocks, itertools.repeat(image_prefix))
+            else: # Starting the workers would take longer than reading it
+                results = map(_extract_pages, itertools.repeat(self.path), 
+                        blocks, itertools.repeat(image_prefix))
             # Now iterate over all the students in the roster
-            for pagenumber in range(self.roster.get_n_pages()):
-                page = self.roster.get_page(pagenumber)
-                pagetext = [(rect.y1, rect.x1, char) for char, rect in 
-                        zip(page.get_text(), page.get_text_layout()[1])]
-                for image_map in page.get_image_mapping():
-                    # Top left corner of image:
-                    x1, y1 = image_map.area.x1, image_map.area.y1
-                    # Grab the text for the student ID number
-                    idnumber = PhotoRoster.get_first_line(pagetext, 
-                            x1 + 169, x1 + 270, y1, y1 + 197)
-                    # Grab the text for the name
-                    name = PhotoRoster.get_first_line(pagetext, 
-                            x1, x1 + 270, y1 + 197, y1 + 216)
-                    # Get the image
-                    if pdfimages_path:
-                        imagenumber = pagenumber * 6 + image_map.image_id
-                        image = "{}-{:03}.jpg".format(image_prefix, imagenumber)
-                    else:
-                        image = page.get_image(image_map.image_id)
-                    # Construct a Student object and yield it
-                    yield Student(idnumber, name, image, self.course_tag)
+            # (The page text, which is the bulk of the memory used for each 
+            # page, stays inside _read_pages and is freed as soon as it 
+            # returns. Here we only need the page itself to get the photos.) 
+            for pages, page_results in zip(blocks, results):
+                for pagenumber, students in zip(pages, page_results):
+                    if not self.use_pdfimages:
+                        page = self.roster.get_page(pagenumber)
+                    for idnumber, name, image_id in students:
+                        # Get the image
+                        if self.use_pdfimages:
+                            imagenumber = (pagenumber - pages[0]) * 6 + image_id
+                            image = "{}-{:04}-{:03}.jpg".format(image_prefix, 
+                                    pages[0], imagenumber)
+                        else:
+                            image = page.get_image(image_id)
+                        # Construct a Student object and yield it
+                        student = Student(idnumber, name, image, 
+                                self.course_tag)
+                        if encoder is None:
+                            yield student
+                            continue
+                        encoding.append(encoder.submit(student.encode_photo))
+                        if len(encoding) > 2 * ENCODE_THREADS:
+                            yield encoding.popleft().result()
+            while encoder and encoding:
+                yield encoding.popleft().result()
+
+    @staticmethod
+    def get_page_text(page):
+        """Get the characters on a page, with their coordinates
+
+        Returns arrays (ys, xs, chars), sorted by y coordinate. The sort is 
+        stable, so the characters within each line stay in order. Newlines 
+        are left out, since they're never part of the text we want. 
+        """
+
+        text = page.get_text()
+        layout = page.get_text_layout()[1]
+        n = min(len(text), len(layout))
+        # Each rectangle attribute is a (slowish) call into Poppler, so make 
+        # just one pass over the rectangles, collecting both coordinates
+        coords = np.fromiter(itertools.chain.from_iterable((rect.y1, rect.x1) 
+                for rect in itertools.islice(layout, n)), np.float64, 2 * n)
+        ys, xs = coords[0::2], coords[1::2]
+        chars = np.array(list(text[:n]), dtype="U1")
+        order = np.argsort(ys, kind="stable")
+        order = order[chars[order] != "\n"]
+        return ys[order], xs[order], chars[order]
 
     @staticmethod
     def get_first_line(pagetext, xmin, xmax, ymin, ymax):
         """Get the first line of text within an area of a page"""
 
-        text = [(y, c) for y, x, c in pagetext if 
-                xmin <= x <= xmax and ymin <= y <= ymax and c != "\n"]
-        top_y = min([y for y, c in text])
-        return "".join([c for y, c in text if y == top_y]).strip()
+        ys, xs, chars = pagetext
+        # The text is sorted by y, so the rows we want are a contiguous slice
+        start = ys.searchsorted(ymin, "left")
+        stop = ys.searchsorted(ymax, "right")
+        ys, xs, chars = ys[start:stop], xs[start:stop], chars[start:stop]
+        found = np.flatnonzero((xs >= xmin) & (xs <= xmax))
+        if not len(found):
+            raise ValueError("No text found in this area of the page")
+        # ...and so the first character we found is on the top line, and the 
+        # top line ends where the y coordinate next goes up
+        end = ys.searchsorted(ys[found[0]], "right")
+        return "".join(chars[found[:found.searchsorted(end)]]).strip()
+
+
+def _read_pages(roster, pages):
+    """Find the students on some pages of a roster (a Poppler document)
+
+    Returns a list with an entry for each page, which is a list of tuples of 
+    the form (idnumber, name, image_id) for the students on that page. 
+    """
+
+    results = []
+    for pagenumber in pages:
+        page = roster.get_page(pagenumber)
+        pagetext = PhotoRoster.get_page_text(page)
+        students = []
+        for image_map in page.get_image_mapping():
+            # Top left corner of image:
+            x1, y1 = image_map.area.x1, image_map.area.y1
+            # Grab the text for the student ID number
+            idnumber = PhotoRoster.get_first_line(pagetext, 
+                    x1 + 169, x1 + 270, y1, y1 + 197)
+            # Grab the text for the name
+            name = PhotoRoster.get_first_line(pagetext, 
+                    x1, x1 + 270, y1 + 197, y1 + 216)
+            students.append((idnumber, name, image_map.image_id))
+        results.append(students)
+    return results
+
+def _extract_pages(path, pages, image_prefix=None):
+    """Like _read_pages, but given the path to the roster
+
+    If image_prefix is given, the photos on these pages are also extracted 
+    with pdfimages, to files named like {image_prefix}-PPPP-NNN.jpg, where 
+    PPPP is the first of these pages and NNN counts the photos from there. 
+    pdfimages runs while the text is being read. 
+    """
+
+    if image_prefix:
+        pdfimages = subprocess.Popen([pdfimages_path, "-j", 
+                "-f", str(pages[0] + 1), "-l", str(pages[-1] + 1), path, 
+                "{}-{:04}".format(image_prefix, pages[0])], 
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    roster = open_document(path, os.path.getmtime(path))
+    results = _read_pages(roster, pages)
+    if image_prefix and pdfimages.wait():
+        raise subprocess.CalledProcessError(pdfimages.returncode, 
+                pdfimages.args)
+    return results
+
+
+@functools.lru_cache(maxsize=1024)
+def file_digest(path, mtime_ns, size):
+    """Compute the BLAKE2b digest of the file at 'path'
+
+    The modification time and size of the file are only there so that the 
+    cached digest is discarded whenever the file changes. 
+    """
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.digest()
+
+def same_contents(path, data):
+    "Check whether the file at 'path' contains exactly the bytes 'data'"
+
+    stat = os.stat(path)
+    if stat.st_size != len(data):
+        return False
+    return (file_digest(path, stat.st_mtime_ns, stat.st_size) == 
+            hashlib.blake2b(data, digest_size=16).digest())
 
 
 class Student(object):
     """A class to represent a single student's information and photo"""
 
+    __slots__ = ("idnumber", "_photo_filename", "name_on_roster", "_names", 
+            "photo", "_tags")
+
+    _next_backup = {} # Photo path -> first backup number that might be unused
+
     def __init__(self, idnumber, name, photo, tags):
         self.idnumber = idnumber
+        self._photo_filename = "UCLA_Student_{}.jpg".format(idnumber)
         self.name_on_roster = name
-        self.preferredname, self.fullname = Student._format_name(name)
+        self._names = None # Formatted from name_on_roster when first needed
         self.photo = photo
-        self.tags = tags.split()
+        self._tags = tags  # Split up when first needed
+
+    @property
+    def preferredname(self):
+        if self._names is None:
+            self._names = Student._format_name(self.name_on_roster)
+        return self._names[0]
+
+    @preferredname.setter
+    def preferredname(self, preferredname):
+        self._names = (preferredname, self.fullname)
+
+    @property
+    def fullname(self):
+        if self._names is None:
+            self._names = Student._format_name(self.name_on_roster)
+        return self._names[1]
+
+    @fullname.setter
+    def fullname(self, fullname):
+        self._names = (self.preferredname, fullname)
+
+    @property
+    def tags(self):
+        if isinstance(self._tags, str):
+            self._tags = self._tags.split()
+        return self._tags
+
+    @tags.setter
+    def tags(self, tags):
+        self._tags = tags
 
     def photo_filename(self):
-        return "UCLA_Student_{}.jpg".format(self.idnumber)
+        return self._photo_filename
 
-    def save_photo(self, directory):
+    def save_photo(self, directory, existing_names=None):
         """Saves the photo to the specified directory
 
         If there was already an existing photo for this student, and the 
@@ -149,34 +456,80 @@ class Student(object):
         even present the user with a choice of which file to keep. For the 
         latter case, note that the path to the new photo will be 
             os.path.join(directory, student.photo_filename)
+
+        If existing_names is given, it should be a set of the names of all the 
+        files in the directory. It is checked instead of the directory itself, 
+        which saves a stat() call per file, and is kept up to date with any 
+        files that this creates. 
         """
 
         photopath = os.path.join(directory, self.photo_filename())
-        photopath_new = photopath_backup = photopath
-        i = 0
-        while os.path.exists(photopath_backup):
-            i += 1
+        if existing_names is None:
+            exists = os.path.exists
+        else:
+            exists = lambda path: os.path.basename(path) in existing_names
+        photopath_backup = photopath
+        if exists(photopath):
+            # Start looking for an unused backup name where we left off last 
+            # time, rather than checking all of .old1, .old2, ... every time
+            i = Student._next_backup.get(photopath, 1)
             photopath_backup = "{}.old{}.jpg".format(photopath[:-4], i)
-        if photopath_backup != photopath:
-            photopath_new = photopath + ".NEW"
-        if pdfimages_path:
-            shutil.move(self.photo, photopath_new)
+            while exists(photopath_backup):
+                i += 1
+                photopath_backup = "{}.old{}.jpg".format(photopath[:-4], i)
+            Student._next_backup[photopath] = i
+        from_pdfimages = isinstance(self.photo, str)
+        if from_pdfimages and photopath_backup == photopath:
+            # Already a JPEG file, and nothing to compare it with, so just 
+            # move it into place
+            shutil.move(self.photo, photopath)
         else:
-            pixbuf = Gdk.pixbuf_get_from_surface(self.photo, 0, 0, 
-                    self.photo.get_width(), self.photo.get_height())
-            pixbuf.savev(photopath_new, "jpeg", ["quality"], ["90"])
+            if from_pdfimages:
+                with open(self.photo, "rb") as photofile:
+                    data = photofile.read()
+            else:
+                data = self.encode_photo().photo
+            if photopath_backup == photopath: # Nothing there to replace
+                with open(photopath, "wb") as photofile:
+                    photofile.write(data)
+            elif same_contents(photopath, data): # Compare before writing
+                return None
+            else:
+                # Write the new photo to a temporary file first, so that the 
+                # existing one is only replaced once the new one is complete
+                photopath_new = photopath + ".NEW"
+                with open(photopath_new, "wb") as photofile:
+                    photofile.write(data)
+                os.rename(photopath, photopath_backup)
+                os.replace(photopath_new, photopath)
         if photopath_backup == photopath: # There was no existing photo
+            if existing_names is not None:
+                existing_names.add(self.photo_filename())
             return None
-        if filecmp.cmp(photopath, photopath_new): # New photo is same as old
-            os.remove(photopath_new)
-            return None
-        os.rename(photopath, photopath_backup)
-        os.rename(photopath_new, photopath)
+        Student._next_backup[photopath] = i + 1
+        if existing_names is not None:
+            existing_names.add(os.path.basename(photopath_backup))
         return photopath_backup # New and old photos are different!
 
+    def encode_photo(self):
+        """Encode the photo as a JPEG in memory, if it isn't one already
+
+        Returns the student, for convenience. The photo is then a bytes object. 
+        Different students' photos can be encoded at the same time in different 
+        threads, ahead of saving them. 
+        """
+
+        if not isinstance(self.photo, (str, bytes)):
+            pixbuf = Gdk.pixbuf_get_from_surface(self.photo, 0, 0, 
+                    self.photo.get_width(), self.photo.get_height())
+            self.photo = pixbuf.save_to_bufferv("jpeg", ["quality"], ["90"])[1]
+        return self
+
     def merge_tags(self, tags):
+        seen = set(tags)
         for tag in self.tags:
-            if tag not in tags:
+            if tag not in seen:
+                seen.add(tag)
                 tags.append(tag)
         self.tags = tags
 
@@ -186,8 +539,16 @@ class Student(object):
                 self.fullname, " ".join(self.tags)))
 
     ##### Several methods to deal with formatting names nicely #####
-    _PARENSFORMAT = re.compile(r'(.*)[(](.*)[)](.*)')
+    # A name is handled in one pass, as a series of tokens, each of which is 
+    # whitespace, a particle standing alone as a word (which is lowercased), 
+    # or one piece of a (possibly hyphenated) word. 
+    _NAME_PARTICLES = ("DE", "EL", "LA", "LOS", "LAS")
+    _NAME_PREFIXES = frozenset(("Mc", "O'", "D'"))
+    _NAME_TOKEN = re.compile(r"(?P<space>\s+)|"
+            r"(?P<particle>(?<!\S)(?:{})(?!\S))|[^\s-]+".format(
+            "|".join(_NAME_PARTICLES)))
     @staticmethod
+    @functools.lru_cache(maxsize=4096)
     def _format_name(name):
         """Take a name as provided by the registrar, and format it nicely
 
@@ -209,9 +570,13 @@ class Student(object):
             A 2-tuple of the form (preferred_name, full_name)
         """
 
-        match = Student._PARENSFORMAT.match(name)
-        if match:
-            name, realfirstname, junk = match.groups()
+        # Split the name up around the last "(" that comes before the last ")", 
+        # if there is one, using plain string methods rather than a regex
+        close = name.rfind(")")
+        open_ = name.rfind("(", 0, close) if close >= 0 else -1
+        if open_ >= 0:
+            name, realfirstname, junk = \
+                    name[:open_], name[open_ + 1:close], name[close + 1:]
             realfirstname = Student._name_fixcase(realfirstname)
             if junk:
                 raise ValueError("Unexpected characters after parentheses " + 
@@ -247,29 +612,28 @@ class Student(object):
                 (realfirstname, middlename, lastname, suffix)))
         return preferredname, fullname
 
+    # The same names turn up over and over again, within a roster and from 
+    # one roster to the next, so remember how each one came out
     @staticmethod
+    @functools.lru_cache(maxsize=4096)
     def _name_fixcase(name):
         "Correct the case (and possibly spacing) of an entire name"
 
-        return " ".join([Student._name_fixcase_hyphenated(word) for word in 
-                name.split()])
+        return Student._NAME_TOKEN.sub(Student._name_fixcase_token, 
+                name.strip())
 
     @staticmethod
-    def _name_fixcase_hyphenated(name):
-        "Take a single (possibly-hyphenated) word from a name, correct its case"
+    def _name_fixcase_token(match):
+        "Correct the case of a single token of a name matched by _NAME_TOKEN"
 
-        if name in ("DE", "EL", "LA", "LOS", "LAS"):
+        if match.lastgroup == "space":
+            return " "
+        name = match.group()
+        if match.lastgroup == "particle":
             return name.lower()
-        return "-".join([Student._name_fixcase_word(word) for word in 
-                name.split("-")])
-
-    @staticmethod
-    def _name_fixcase_word(name):
-        "Take a single (nonhyphenated) word from a name, correct its case"
-
         name = name[:1] + name[1:].lower()    # No, I don't mean to use title()
-        if name[:2] in ("Mc", "O'", "D'"):
-            name = name[:2] + name[2:3].upper() + name[3:]
+        if len(name) > 2 and name[:2] in Student._NAME_PREFIXES:
+            name = name[:2] + name[2].upper() + name[3:]
         return name
 
 